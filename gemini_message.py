@@ -1,4 +1,8 @@
 import os
+import random
+import threading
+from bisect import bisect_right
+from functools import lru_cache
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
@@ -10,6 +14,62 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 MODEL = "gemini-2.5-flash-lite"
 
+FALLBACK_MESSAGES = (
+    "Keep up the amazing work! 🌟",
+    "You're crushing it! 🚀",
+    "Excellence recognized! 👏",
+    "Your awesomeness is showing! ✨",
+    "Making magic happen! 🎯",
+    "Stellar performance! ⭐",
+    "You're on fire! 🔥",
+    "Absolutely brilliant! 💎",
+    "Shining bright! 💫",
+    "Legendary work! 🏆",
+)
+
+# Kudos totals are rounded down to these milestones before prompting, so that
+# receivers with similar totals share a cached message
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+PROMPT_TEMPLATE = """Generate a short, encouraging, positive, and witty message (1-2 sentences max) 
+to celebrate someone receiving kudos {context}. 
+
+The message should be:
+- Uplifting and celebratory
+- Professional but friendly
+- Include an appropriate emoji
+- Be concise (under 100 characters if possible)
+- Witty or clever when appropriate
+
+Just return the message itself, nothing else."""
+
+# Prompt for the common message + count case, with {MSG} and {N} left to fill in
+MESSAGE_AND_COUNT_PROMPT = PROMPT_TEMPLATE.format(
+    context="with the message: '{MSG}' bringing their total to {N}+ kudos"
+)
+
+# Kudos messages are a sentence or two, so cap the output to cut tail latency
+GENERATION_CONFIG = types.GenerateContentConfig(
+    max_output_tokens=40,
+    temperature=0.9,
+    response_mime_type="text/plain",
+    candidate_count=1,
+)
+
+# Shared Gemini client, created on first use so importing this module stays cheap
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> genai.Client:
+    """Return the shared Gemini client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(api_key=GEMINI_API_KEY)
+    return _client
+
 
 def generate_kudos_message(
     receiver_name: str = None,
@@ -30,11 +90,49 @@ def generate_kudos_message(
     Returns:
         A generated encouraging message, or a fallback message if generation fails
     """
+    # A bare "++" gives the model nothing to work with, so skip the API call
+    if not any((receiver_name, giver_name, kudos_message)):
+        return get_fallback_message()
+
+    if not GEMINI_API_KEY:
+        print("Warning: GEMINI_API_KEY not set, using fallback message")
+        return get_fallback_message()
+
     try:
-        if not GEMINI_API_KEY:
-            print("Warning: GEMINI_API_KEY not set, using fallback message")
-            return get_fallback_message()
-        
+        return _generate_message(
+            receiver_name, giver_name, kudos_message, bucket_kudos_count(kudos_count)
+        )
+    except Exception as e:
+        print(f"Error generating Gemini message: {e}")
+        return get_fallback_message()
+
+
+def bucket_kudos_count(kudos_count: int = None) -> int:
+    """Round a kudos total down to the nearest milestone in COUNT_BUCKETS."""
+    if not kudos_count:
+        return kudos_count
+    return COUNT_BUCKETS[max(bisect_right(COUNT_BUCKETS, kudos_count) - 1, 0)]
+
+
+@lru_cache(maxsize=1024)
+def _generate_message(
+    receiver_name: str,
+    giver_name: str,
+    kudos_message: str,
+    kudos_count: int
+) -> str:
+    """
+    Ask Gemini for a kudos message, memoized on the prompt inputs.
+
+    Raises on failure, an empty response or a truncated one so that fallback
+    messages are never cached in place of a generated one.
+    """
+    # The Slack handler only ever passes a message and a count, so that shape
+    # skips building the context piece by piece
+    if kudos_message and kudos_count and not (giver_name or receiver_name):
+        # Fill in the count first so "{N}" inside the user's message is left alone
+        prompt = MESSAGE_AND_COUNT_PROMPT.replace("{N}", str(kudos_count)).replace("{MSG}", kudos_message)
+    else:
         # Build context for the AI
         context_parts = []
         if giver_name:
@@ -44,60 +142,29 @@ def generate_kudos_message(
         if kudos_message:
             context_parts.append(f"with the message: '{kudos_message}'")
         if kudos_count:
-            context_parts.append(f"bringing their total to {kudos_count} kudos")
-        
-        context = " ".join(context_parts) if context_parts else "for great work"
-        
-        # Create the prompt
-        prompt = f"""Generate a short, encouraging, positive, and witty message (1-2 sentences max) 
-to celebrate someone receiving kudos {context}. 
+            context_parts.append(f"bringing their total to {kudos_count}+ kudos")
 
-The message should be:
-- Uplifting and celebratory
-- Professional but friendly
-- Include an appropriate emoji
-- Be concise (under 100 characters if possible)
-- Witty or clever when appropriate
+        # Create the prompt (generate_kudos_message guarantees some context)
+        prompt = PROMPT_TEMPLATE.format(context=" ".join(context_parts))
 
-Just return the message itself, nothing else."""
+    # Generate the message (the client keeps its connections warm between calls)
+    response = get_client().models.generate_content(
+        model=MODEL,
+        contents=prompt,
+        config=GENERATION_CONFIG
+    )
 
-        # Initialize the client
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        
-        # Generate the message
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt
-        )
-        
-        if response and response.text:
-            return response.text.strip()
-        else:
-            return get_fallback_message()
-            
-    except Exception as e:
-        print(f"Error generating Gemini message: {e}")
-        return get_fallback_message()
+    if not (response and response.text):
+        raise ValueError("Gemini returned an empty response")
+    # A reply cut off at max_output_tokens must not be posted or cached
+    if response.candidates and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS:
+        raise ValueError("Gemini response hit max_output_tokens")
+    return response.text.strip()
 
 
 def get_fallback_message() -> str:
     """Return a fallback message if Gemini generation fails."""
-    import random
-    
-    fallback_messages = [
-        "Keep up the amazing work! 🌟",
-        "You're crushing it! 🚀",
-        "Excellence recognized! 👏",
-        "Your awesomeness is showing! ✨",
-        "Making magic happen! 🎯",
-        "Stellar performance! ⭐",
-        "You're on fire! 🔥",
-        "Absolutely brilliant! 💎",
-        "Shining bright! 💫",
-        "Legendary work! 🏆"
-    ]
-    
-    return random.choice(fallback_messages)
+    return random.choice(FALLBACK_MESSAGES)
 
 
 # For testing
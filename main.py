@@ -1,7 +1,14 @@
+import heapq
 import os
+import queue
 import re
-import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
 
+import apsw
 from dotenv import load_dotenv
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
@@ -19,26 +26,92 @@ SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
 app = App(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
 
 # Kudos detection pattern: "<@U12345> ++ optional message"
-# Uses non-greedy match and lookahead to support multiple kudos in one message
+# Only the "<@ID> ++" marker is matched; each message is the text up to the
+# next marker, which supports multiple kudos in one message without backtracking
 # e.g., "<@U123> ++ great work <@U456> ++ awesome job"
-MENTION_PLUS_PATTERN = re.compile(r"<@([A-Z0-9]+)>\s*\+\+\s*(.*?)(?=<@[A-Z0-9]+>\s*\+\+|$)")
+MENTION_PLUS_PATTERN = re.compile(r"<@([A-Z0-9]+)>\s*\+\+")
+
+def parse_kudos(text: str) -> list[tuple[str, str]]:
+    """Split text into (target_user_id, message) pairs in a single linear scan."""
+    hits = list(MENTION_PLUS_PATTERN.finditer(text))
+    return [
+        (hit.group(1), text[hit.end():hits[i + 1].start() if i + 1 < len(hits) else len(text)])
+        for i, hit in enumerate(hits)
+    ]
+
+# Case-insensitive search avoids lowercasing a copy of every mention's text
+LEADERBOARD_PATTERN = re.compile(r"leaderboard", re.IGNORECASE)
 
 # --- SQLite setup ---
 DB_PATH = os.getenv("DB_PATH", "/home/ubuntu/kudos.db")
 
+# kudos_log rows are written in the background, committing up to this many rows
+# at a time, or whatever has queued up within this many seconds
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 0.5
+# Seconds to wait before retrying a log batch while another process holds the lock
+LOG_RETRY_DELAY = 1.0
+
+# Errors caused by the contents of a single log row rather than the database
+LOG_ROW_ERRORS = (UnicodeEncodeError, apsw.ConstraintError, apsw.TooBigError)
+
+# How often to refresh query planner statistics and checkpoint the WAL (seconds)
+MAINTENANCE_INTERVAL = 15 * 60
+
+def connect_db() -> apsw.Connection:
+    """Open a connection with WAL and the per-connection tuning PRAGMAs applied."""
+    # apsw connections autocommit; multi-statement writes go through transaction()
+    conn = apsw.Connection(DB_PATH)
+    conn.setbusytimeout(5000)
+    # SQLite's default autocheckpoint threshold (1000 pages), set explicitly
+    conn.wal_autocheckpoint(1000)
+    # WAL lets reads proceed alongside writes; NORMAL skips the extra fsync per commit
+    conn.pragma("journal_mode", "wal")
+    conn.pragma("synchronous", "normal")
+    conn.pragma("temp_store", "memory")
+    conn.pragma("cache_size", -64000)  # ~64 MB page cache
+    conn.pragma("mmap_size", 268435456)  # 256 MB
+    return conn
+
+# Single long-lived connection shared by all handlers. Bolt dispatches events
+# on a thread pool, so every use of it must hold _LOCK.
+_CONN = connect_db()
+_LOCK = threading.Lock()
+
+# In-memory mirror of the kudos table, loaded by init_db(). The bot is the only
+# writer, so counts can be read from here without touching SQLite. Guarded by _LOCK.
+_COUNTS: dict[str, int] = {}
+
+# (receiver_id, giver_id, message) rows waiting to be written by log_writer().
+# Rows still queued when the process dies are lost.
+_LOG_QUEUE: queue.Queue = queue.Queue()
+
+@contextmanager
+def transaction():
+    """Run the enclosed statements on _CONN in one write transaction. Caller must hold _LOCK."""
+    _CONN.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        _CONN.execute("COMMIT")
+    except BaseException:
+        # A failed COMMIT can leave the transaction open; never leave _CONN inside one
+        if not _CONN.getautocommit():
+            _CONN.execute("ROLLBACK")
+        raise
+
 def init_db():
-    """Create table if not exists."""
+    """Create tables and indexes if not exists and load the current counts."""
     print("Running with DB_PATH: ", DB_PATH)
-    with sqlite3.connect(DB_PATH) as conn:
+    with _LOCK:
         # Aggregated kudos count table
-        conn.execute("""
+        _CONN.execute("""
             CREATE TABLE IF NOT EXISTS kudos (
                 user_id TEXT PRIMARY KEY,
                 count INTEGER DEFAULT 0
             )
         """)
         # Detailed kudos log table
-        conn.execute("""
+        _CONN.execute("""
             CREATE TABLE IF NOT EXISTS kudos_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 receiver_id TEXT NOT NULL,
@@ -47,44 +120,119 @@ def init_db():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        conn.commit()
-
-def increment_kudos(user_id: str, giver_id: str = None, message: str = None):
-    """Increment kudos count for a user and log the transaction."""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        # Update aggregated count
-        cursor.execute("""
-            INSERT INTO kudos (user_id, count)
-            VALUES (?, 1)
-            ON CONFLICT(user_id)
-            DO UPDATE SET count = count + 1;
-        """, (user_id,))
-        # Log the transaction
-        if giver_id:
-            cursor.execute("""
-                INSERT INTO kudos_log (receiver_id, giver_id, message)
-                VALUES (?, ?, ?)
-            """, (user_id, giver_id, message))
-        conn.commit()
-
-def get_kudos(user_id: str) -> int:
-    """Return current kudos count."""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT count FROM kudos WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        return row[0] if row else 0
+        # The leaderboard is served from _COUNTS, so a count index would only slow writes
+        _CONN.execute("DROP INDEX IF EXISTS idx_kudos_count")
+        # For per-user kudos history lookups
+        _CONN.execute("CREATE INDEX IF NOT EXISTS idx_log_receiver ON kudos_log(receiver_id)")
+        # Planner statistics are left to the PRAGMA optimize run in maintain_db()
+        _COUNTS.update(_CONN.execute("SELECT user_id, count FROM kudos"))
+
+def maintain_db():
+    """Optimize and checkpoint the database now, then every MAINTENANCE_INTERVAL seconds."""
+    try:
+        with _LOCK:
+            # Refreshes planner statistics where SQLite thinks they are stale
+            _CONN.pragma("optimize")
+            # Also checkpoint on a timer, not only when a commit crosses the
+            # autocheckpoint threshold; PASSIVE never blocks writers
+            _CONN.wal_checkpoint(mode=apsw.SQLITE_CHECKPOINT_PASSIVE)
+    except apsw.Error as e:
+        print(f"Error maintaining database: {e}")
+    timer = threading.Timer(MAINTENANCE_INTERVAL, maintain_db)
+    timer.daemon = True
+    timer.start()
+
+def increment_kudos_batch(kudos: list[tuple[str, str]], giver_id: str) -> list[int]:
+    """Record several (receiver_id, message) kudos and return their new counts.
+
+    The counts are committed in one transaction before returning; the log rows
+    are handed to log_writer() and written shortly after.
+    """
+    # One upsert row per receiver, even if they were mentioned more than once
+    increments = Counter(user_id for user_id, _ in kudos)
+    with _LOCK:
+        # All count updates for a Slack message share a single commit
+        with transaction():
+            _CONN.executemany("""
+                INSERT INTO kudos (user_id, count)
+                VALUES (?, ?)
+                ON CONFLICT(user_id)
+                DO UPDATE SET count = count + excluded.count
+            """, increments.items())
+        # Only mirror the counts once the transaction has committed, giving each
+        # kudos the running total at its position in the message
+        new_counts = []
+        for user_id, _ in kudos:
+            _COUNTS[user_id] = _COUNTS.get(user_id, 0) + 1
+            new_counts.append(_COUNTS[user_id])
+    # Log the transactions off the request path
+    for user_id, message in kudos:
+        _LOG_QUEUE.put((user_id, giver_id, message))
+    return new_counts
+
+def write_log_rows(rows: list[tuple[str, str, str]]):
+    """Insert (receiver_id, giver_id, message) rows into kudos_log in one transaction.
+
+    Retries for as long as the database is locked by another connection (e.g. the
+    sqlite3 CLI), so contention delays the rows instead of losing them.
+    """
+    while True:
+        try:
+            with _LOCK, transaction():
+                _CONN.executemany("""
+                    INSERT INTO kudos_log (receiver_id, giver_id, message)
+                    VALUES (?, ?, ?)
+                """, rows)
+            return
+        except (apsw.BusyError, apsw.LockedError) as e:
+            print(f"Kudos log is locked ({e}), retrying in {LOG_RETRY_DELAY}s")
+            time.sleep(LOG_RETRY_DELAY)
+
+def sanitize_log_row(row: tuple[str, str, str]) -> tuple[str, str, str]:
+    """Replace characters SQLite cannot store (e.g. lone surrogates) in the message."""
+    receiver_id, giver_id, message = row
+    if message:
+        message = message.encode("utf-8", "replace").decode("utf-8")
+    return receiver_id, giver_id, message
+
+def log_writer():
+    """Drain _LOG_QUEUE into kudos_log forever, one transaction per batch."""
+    while True:
+        rows = [_LOG_QUEUE.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            try:
+                rows.append(_LOG_QUEUE.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        try:
+            write_log_rows(rows)
+        except LOG_ROW_ERRORS:
+            print("Error writing kudos log batch, retrying row by row:")
+            traceback.print_exc()
+            # Retry one at a time so a single bad row doesn't cost the whole batch
+            for row in rows:
+                try:
+                    write_log_rows([sanitize_log_row(row)])
+                except LOG_ROW_ERRORS:
+                    print(f"Dropping kudos log row {row!r}:")
+                    traceback.print_exc()
+                except Exception:
+                    print(f"Error writing kudos log row {row!r}:")
+                    traceback.print_exc()
+        except Exception:
+            print(f"Error writing kudos log, dropping {len(rows)} rows:")
+            traceback.print_exc()
 
 def get_leaderboard(limit: int = 10):
     """Return top N users."""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, count FROM kudos ORDER BY count DESC LIMIT ?", (limit,))
-        return cursor.fetchall()
+    with _LOCK:
+        return heapq.nlargest(limit, _COUNTS.items(), key=lambda item: item[1])
 
 # Initialize database
 init_db()
+maintain_db()
+threading.Thread(target=log_writer, daemon=True).start()
 
 # --- Slack Event Handlers ---
 
@@ -94,11 +242,14 @@ def handle_message_events(event, say):
     text = event.get("text", "")
     thread_ts = event.get("thread_ts") or event.get("ts")  # reply in same thread
 
-    if not text or not user:
+    # Most messages carry no kudos; a substring check rules them out before any regex work
+    if not text or not user or "++" not in text:
+        return
+    if not MENTION_PLUS_PATTERN.search(text):
         return
 
-    matches = MENTION_PLUS_PATTERN.findall(text)
-    for target_user_id, message in matches:
+    kudos = []
+    for target_user_id, message in parse_kudos(text):
         if target_user_id == user:
             say(
                 text=f"Nice try <@{user}> 😜 You can’t give kudos to yourself!",
@@ -107,12 +258,15 @@ def handle_message_events(event, say):
             continue
 
         # Extract and clean the message (strip whitespace)
-        kudos_message = message.strip() if message else None
-        
-        # Save kudos with giver, timestamp (auto), and message
-        increment_kudos(target_user_id, giver_id=user, message=kudos_message)
-        new_count = get_kudos(target_user_id)
-        
+        kudos.append((target_user_id, message.strip() or None))
+
+    if not kudos:
+        return
+
+    # Save all kudos with giver, timestamp (auto), and message in one commit
+    new_counts = increment_kudos_batch(kudos, giver_id=user)
+
+    for (target_user_id, kudos_message), new_count in zip(kudos, new_counts):
         # Generate an encouraging AI message
         ai_message = generate_kudos_message(
             kudos_message=kudos_message,
@@ -126,18 +280,19 @@ def handle_message_events(event, say):
 
 @app.event("app_mention")
 def show_help_or_leaderboard(event, say):
-    text = event.get("text", "").lower()
     thread_ts = event.get("thread_ts") or event.get("ts")
 
-    if "leaderboard" in text:
+    if LEADERBOARD_PATTERN.search(event.get("text", "")):
         leaderboard = get_leaderboard()
         if not leaderboard:
             say("No kudos given yet! Be the first to appreciate someone with `@user ++` 🎉", thread_ts=thread_ts)
             return
-        message = ":trophy: *Kudos Leaderboard:*\n"
-        for rank, (user_id, count) in enumerate(leaderboard, start=1):
-            message += f"{rank}. <@{user_id}> — {count} kudos\n"
-        say(message, thread_ts=thread_ts)
+        lines = [":trophy: *Kudos Leaderboard:*"]
+        lines.extend(
+            f"{rank}. <@{user_id}> — {count} kudos"
+            for rank, (user_id, count) in enumerate(leaderboard, start=1)
+        )
+        say("\n".join(lines), thread_ts=thread_ts)
     else:
         say(
             "Hey there! 👋\n"